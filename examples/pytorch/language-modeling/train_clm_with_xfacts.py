@@ -23,42 +23,50 @@ https://huggingface.co/models?filter=text-generation
 # You can also adapt this script on your own causal language modeling task. Pointers for this are left as comments.
 
 from torch.nn import CrossEntropyLoss
+from torch.nn.utils.rnn import pad_sequence
 import argparse
+import contextlib
 import copy
+import hashlib
+import inspect
+import json
 import logging
 import math
 import os
 import numpy as np
 import random
-from itertools import chain
+from functools import partial
+import re
 from pathlib import Path
 
 import datasets
 import torch
 from datasets import load_dataset
+from packaging import version
 from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
 import transformers
-from accelerate import Accelerator, DistributedType
+from accelerate import Accelerator, DataLoaderConfiguration, DistributedDataParallelKwargs, DistributedType
 from huggingface_hub import Repository
 from transformers import (
     CONFIG_MAPPING,
     MODEL_MAPPING,
-    AdamW,
     AutoConfig,
     AutoModelForCausalLM,
     AutoTokenizer,
+    DataCollatorWithPadding,
     SchedulerType,
     default_data_collator,
     get_scheduler,
     set_seed,
 )
+from transformers.modeling_utils import no_init_weights
 from transformers.utils import get_full_repo_name
 from transformers.utils.versions import require_version
 # Hardcoded to use the type I want
 from transformers.models.gpt2.modeling_gpt2 import GPT2ProbedCLM, GPT2ForSequenceClassification
-from transformers.utils.gen_xfactuals import gen_counterfactual
+from transformers.utils.gen_xfactuals import gen_counterfactual, get_z_buffer
 
 
 logger = logging.getLogger(__name__)
@@ -128,6 +136,15 @@ def parse_args():
         default=None,
         help="Pretrained tokenizer name or path if not the same as model_name",
     )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help=(
+            "Where to store the pretrained models, configs and tokenizers downloaded from huggingface.co. Point it"
+            " to a fast local disk (e.g. under /dev/shm) to speed up repeated runs."
+        ),
+    )
     parser.add_argument(
         "--use_slow_tokenizer",
         action="store_true",
@@ -152,6 +169,11 @@ def parse_args():
         help="Initial learning rate (after the potential warmup period) to use.",
     )
     parser.add_argument("--weight_decay", type=float, default=0.0, help="Weight decay to use.")
+    parser.add_argument(
+        "--use_8bit_adam",
+        action="store_true",
+        help="If passed, use the 8-bit AdamW from bitsandbytes instead of the fused torch AdamW.",
+    )
     parser.add_argument("--num_train_epochs", type=int, default=3, help="Total number of training epochs to perform.")
     parser.add_argument(
         "--max_train_steps",
@@ -165,6 +187,28 @@ def parse_args():
         default=1,
         help="Number of updates steps to accumulate before performing a backward/update pass.",
     )
+    parser.add_argument(
+        "--no_tf32",
+        action="store_true",
+        help="Do not use TF32 matmuls or cuDNN autotuning, e.g. for exactly reproducible runs.",
+    )
+    parser.add_argument(
+        "--gradient_checkpointing",
+        action="store_true",
+        help="If True, use gradient checkpointing to save memory at the expense of slower backward pass.",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "fp16", "bf16"],
+        help="Whether to use mixed precision. Choose between fp16 and bf16 (bfloat16), bf16 requires an Ampere GPU.",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="If passed, compile the model with `torch.compile` (requires PyTorch 2.2) to fuse its kernels.",
+    )
     parser.add_argument(
         "--lr_scheduler_type",
         type=SchedulerType,
@@ -196,6 +240,57 @@ def parse_args():
         default=None,
         help="The number of processes to use for the preprocessing.",
     )
+    parser.add_argument(
+        "--pad_to_multiple_of",
+        type=int,
+        default=None,
+        help=(
+            "If set, pad the probe batches to a multiple of this value (e.g. 8 to align with tensor cores), which"
+            " allows batch sizes > 1 for the probe."
+        ),
+    )
+    parser.add_argument(
+        "--pad_to_max_length",
+        action="store_true",
+        help=(
+            "If passed, pad the probe batches to the LM block size, so every stage works on the same shapes and can"
+            " reuse the cached GPU memory of the others."
+        ),
+    )
+    parser.add_argument(
+        "--xfact_batch_size",
+        type=int,
+        default=64,
+        help="Number of sentences whose counterfactuals (one per target gender) are searched for together.",
+    )
+    parser.add_argument(
+        "--xfact_train_batch_size",
+        type=int,
+        default=1024,
+        help=(
+            "Batch size (per device) for training the LM head on the xfact dataset. Each example is a single"
+            " embedding, so this can be much larger than --per_device_train_batch_size."
+        ),
+    )
+    parser.add_argument(
+        "--xfact_optimizer",
+        type=str,
+        default="sgd",
+        choices=["sgd", "lbfgs"],
+        help="The optimizer used to search for counterfactual embeddings.",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Number of subprocesses to use for data loading. 0 means loading in the main process.",
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches loaded in advance by each worker. Only used if --dataloader_num_workers > 0.",
+    )
     parser.add_argument(
         "--overwrite_cache", type=bool, default=False, help="Overwrite the cached training and evaluation sets"
     )
@@ -221,6 +316,9 @@ def parse_args():
             extension = args.validation_file.split(".")[-1]
             assert extension in ["csv", "json", "txt"], "`validation_file` should be a csv, json or txt file."
 
+    if args.torch_compile and not hasattr(torch.nn.Module, "compile"):
+        raise ValueError("`--torch_compile` requires PyTorch 2.2 or higher.")
+
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
 
@@ -280,19 +378,34 @@ def _load_dataset(args, dataset_name, dataset_config_name, use_file=False):
     return raw_datasets
 
 
+def tokenize_function(examples, tokenizer, text_column_name, **tokenizer_kwargs):
+    # Defined at module level (and bound with `functools.partial`) so that `datasets` computes the same fingerprint for
+    # every stage and run, and can reuse its cached results.
+    return tokenizer(examples[text_column_name], **tokenizer_kwargs)
+
+
+def sequence_lengths(examples):
+    # Module level for the same reason as tokenize_function.
+    return {"length": [len(input_ids) for input_ids in examples["input_ids"]]}
+
+
 def get_group_text_fn(block_size):
     # Main data processing function that will concatenate all texts from our dataset and generate chunks of block_size.
     def group_texts(examples):
-        # Concatenate all texts.
-        concatenated_examples = {k: list(chain(*examples[k])) for k in examples.keys()}
+        # Concatenate all texts into one contiguous buffer per column, instead of one Python object per token.
+        concatenated_examples = {
+            k: np.concatenate([np.asarray(x, dtype=np.int64) for x in examples[k]]) for k in examples.keys()
+        }
         total_length = len(concatenated_examples[list(examples.keys())[0]])
         # We drop the small remainder, we could add padding if the model supported it instead of this drop, you can
         # customize this part to your needs.
         if total_length >= block_size:
             total_length = (total_length // block_size) * block_size
-        # Split by chunks of max_len.
+        # Split by chunks of max_len. Reshaping one array is much cheaper than slicing Python lists chunk by chunk.
+        # A remainder shorter than block_size (only possible when total_length < block_size) becomes the only chunk.
+        chunk_size = block_size if total_length >= block_size else max(total_length, 1)
         result = {
-            k: [t[i: i + block_size] for i in range(0, total_length, block_size)]
+            k: t[:total_length].reshape(-1, chunk_size).tolist()
             for k, t in concatenated_examples.items()
         }
         result["labels"] = result["input_ids"].copy()
@@ -300,25 +413,7 @@ def get_group_text_fn(block_size):
     return group_texts
 
 
-def _train_lm(args, probed_model, tokenizer, accelerator, raw_datasets):
-    # Preprocessing the datasets.
-    # First we tokenize all the texts.
-    column_names = raw_datasets["train"].column_names
-    text_column_name = "text" if "text" in column_names else column_names[0]
-
-    def tokenize_function(examples):
-        return tokenizer(examples[text_column_name])
-
-    with accelerator.main_process_first():
-        tokenized_lm_datasets = raw_datasets.map(
-            tokenize_function,
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            remove_columns=column_names,
-            load_from_cache_file=not args.overwrite_cache,
-            desc="Running tokenizer on dataset",
-        )
-
+def _get_block_size(args, tokenizer):
     if args.block_size is None:
         block_size = tokenizer.model_max_length
         if block_size > 1024:
@@ -334,22 +429,44 @@ def _train_lm(args, probed_model, tokenizer, accelerator, raw_datasets):
                 f"({tokenizer.model_max_length}). Using block_size={tokenizer.model_max_length}."
             )
         block_size = min(args.block_size, tokenizer.model_max_length)
+    return block_size
 
-    # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
-    # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
-    # to preprocess.
-    #
-    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
-    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
 
+# The grouped LM caches already rebuilt in this run. --overwrite_cache only rebuilds each of them once: the later LM
+# stages load what the first one saved.
+_rebuilt_lm_caches = set()
+
+
+def _train_lm(args, probed_model, tokenizer, accelerator, raw_datasets):
+    block_size = _get_block_size(args, tokenizer)
+
+    # The grouped datasets are saved under the output dir, so later stages and runs can skip the preprocessing. The
+    # directory is keyed by everything the grouped data depends on. Pass --overwrite_cache to rebuild them anyway.
+    cache_path = None
+    if args.output_dir is not None:
+        cache_key = [
+            args.lm_dataset_name,
+            args.lm_dataset_config_name,
+            args.train_file,
+            args.validation_file,
+            args.validation_split_percentage,
+            tokenizer.name_or_path,
+            len(tokenizer),
+            block_size,
+        ]
+        digest = hashlib.sha256(json.dumps(cache_key).encode()).hexdigest()[:16]
+        cache_path = Path(args.output_dir) / f"lm_grouped_bs{block_size}_{digest}"
     with accelerator.main_process_first():
-        lm_datasets = tokenized_lm_datasets.map(
-            get_group_text_fn(block_size),
-            batched=True,
-            num_proc=args.preprocessing_num_workers,
-            load_from_cache_file=not args.overwrite_cache,
-            desc=f"Grouping texts in chunks of {block_size}",
-        )
+        # Only the main process rebuilds: the others run after it and load what it saved.
+        rebuild = args.overwrite_cache and accelerator.is_main_process and cache_path not in _rebuilt_lm_caches
+        if cache_path is not None and cache_path.exists() and not rebuild:
+            logger.info(f"Loading the grouped LM datasets from {cache_path}")
+            lm_datasets = datasets.load_from_disk(str(cache_path))
+        else:
+            lm_datasets = _tokenize_and_group_lm_datasets(args, tokenizer, raw_datasets, block_size)
+            if cache_path is not None and accelerator.is_main_process:
+                lm_datasets.save_to_disk(str(cache_path))
+                _rebuilt_lm_caches.add(cache_path)
 
     train_dataset = lm_datasets["train"]
     eval_dataset = lm_datasets["validation"]
@@ -360,6 +477,36 @@ def _train_lm(args, probed_model, tokenizer, accelerator, raw_datasets):
     train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args, accelerator, tokenizer)
 
 
+def _tokenize_and_group_lm_datasets(args, tokenizer, raw_datasets, block_size):
+    # Preprocessing the datasets.
+    # First we tokenize all the texts.
+    column_names = raw_datasets["train"].column_names
+    text_column_name = "text" if "text" in column_names else column_names[0]
+
+    tokenized_lm_datasets = raw_datasets.map(
+        partial(tokenize_function, tokenizer=tokenizer, text_column_name=text_column_name),
+        batched=True,
+        num_proc=args.preprocessing_num_workers,
+        remove_columns=column_names,
+        load_from_cache_file=not args.overwrite_cache,
+        desc="Running tokenizer on dataset",
+    )
+
+    # Note that with `batched=True`, this map processes 1,000 texts together, so group_texts throws away a remainder
+    # for each of those groups of 1,000 texts. You can adjust that batch_size here but a higher value might be slower
+    # to preprocess.
+    #
+    # To speed up this part, we use multiprocessing. See the documentation of the map method for more information:
+    # https://huggingface.co/docs/datasets/package_reference/main_classes.html#datasets.Dataset.map
+    return tokenized_lm_datasets.map(
+        get_group_text_fn(block_size),
+        batched=True,
+        num_proc=args.preprocessing_num_workers,
+        load_from_cache_file=not args.overwrite_cache,
+        desc=f"Grouping texts in chunks of {block_size}",
+    )
+
+
 def _train_probe(args, probed_model, tokenizer, accelerator, raw_datasets):
     # For imdb
     # text_column_name = 'review'
@@ -370,20 +517,22 @@ def _train_probe(args, probed_model, tokenizer, accelerator, raw_datasets):
     label_column_name = 'gender'
     label_mapping = {0: 0, 1: 1, 2: 2}
 
-    def tokenize_function(examples):
-        tokenized_batch = tokenizer(examples[text_column_name])
-        return tokenized_batch
-
     def label_to_int(batch):
         batch[label_column_name] = [label_mapping[label] for label in batch[label_column_name]]
         return batch
 
+    # With --pad_to_max_length, the probe batches are padded to the LM block size, so the probe and LM stages allocate
+    # buffers of the same shapes. Sentences longer than that are dropped instead of truncated.
+    max_length = _get_block_size(args, tokenizer) if args.pad_to_max_length else None
+
     def too_long(batch):
+        if max_length is not None and len(batch['input_ids']) > max_length:
+            return False
         return len(batch['input_ids']) < tokenizer.model_max_length
 
     with accelerator.main_process_first():
         tokenized_datasets = raw_datasets.map(
-            tokenize_function,
+            partial(tokenize_function, tokenizer=tokenizer, text_column_name=text_column_name),
             batched=True,
             num_proc=args.preprocessing_num_workers,
             load_from_cache_file=not args.overwrite_cache,
@@ -392,18 +541,123 @@ def _train_probe(args, probed_model, tokenizer, accelerator, raw_datasets):
     tokenized_datasets = tokenized_datasets.map(label_to_int, batched=True)
     tokenized_datasets = tokenized_datasets.filter(too_long, batched=False)
     tokenized_datasets = tokenized_datasets.rename_column(label_column_name, 'labels')
+    data_collator = default_data_collator
+    if args.pad_to_multiple_of is not None or args.pad_to_max_length:
+        data_collator = get_probe_data_collator(args, tokenizer, max_length)
+        tokenized_datasets = _keep_probe_columns(tokenized_datasets)
     train_dataset = tokenized_datasets["train"]
     eval_dataset = tokenized_datasets["validation"]
-    train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args, accelerator, tokenizer)
+    train_with_prepped_dataset(
+        train_dataset, eval_dataset, probed_model, args, accelerator, tokenizer, data_collator=data_collator
+    )
+
+
+def get_probe_data_collator(args, tokenizer, max_length=None):
+    # Packing several sentences into one sequence would mix their labels, so we only pad them. The padded positions are
+    # masked out before the probe, so they look the same to it as its own zero-padding.
+    return DataCollatorWithPadding(
+        tokenizer,
+        padding="max_length" if args.pad_to_max_length else True,
+        max_length=max_length,
+        pad_to_multiple_of=args.pad_to_multiple_of,
+    )
+
+
+def _keep_probe_columns(tokenized_datasets):
+    # The padding collator can only batch the model inputs, so drop the text (and any other) columns.
+    model_columns = ["input_ids", "attention_mask", "labels"]
+    return tokenized_datasets.remove_columns(
+        [name for name in tokenized_datasets["train"].column_names if name not in model_columns]
+    )
+
+
+def get_dataloader_kwargs(args):
+    # Load batches in background workers into pinned memory so host-to-device copies can overlap with compute.
+    kwargs = {"num_workers": args.dataloader_num_workers, "pin_memory": torch.cuda.is_available()}
+    if args.dataloader_num_workers > 0:
+        kwargs["persistent_workers"] = True
+        kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+    return kwargs
+
+
+class DataPrefetcher:
+    """
+    Wraps a dataloader yielding dicts of tensors and copies the next batch to `device` on a side CUDA stream, so the
+    host-to-device transfer overlaps with the compute on the current batch. Needs a loader that returns pinned memory
+    and does not place batches on the device itself.
 
+    Since it reads one batch ahead, a prepared loader flags its end one batch early, so this must not be combined with
+    `accelerator.accumulate` or `accelerator.gather_for_metrics`.
+    """
 
-def train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args, accelerator, tokenizer):
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.iterator = iter(self.loader)
+        self.preload()
+        return self
+
+    def preload(self):
+        try:
+            batch = next(self.iterator)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.batch = {
+                k: v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v for k, v in batch.items()
+            }
+
+    def __next__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.batch
+        if batch is None:
+            raise StopIteration
+        # The tensors were allocated on the side stream, make sure the allocator knows they are used on this one.
+        for v in batch.values():
+            if isinstance(v, torch.Tensor):
+                v.record_stream(current_stream)
+        self.preload()
+        return batch
+
+
+def create_optimizer(args, params):
+    # Weight decay and eps match the `transformers.AdamW` defaults so plain parameter lists behave the same.
+    if args.use_8bit_adam:
+        try:
+            import bitsandbytes as bnb
+        except ImportError:
+            raise ImportError("To use 8-bit Adam, please install bitsandbytes: `pip install bitsandbytes`.")
+        return bnb.optim.AdamW8bit(params, lr=args.learning_rate, eps=1e-6, weight_decay=0.0)
+    # The fused kernel does the whole update in a single launch, but needs CUDA params and a recent torch.
+    fused = torch.cuda.is_available() and "fused" in inspect.signature(torch.optim.AdamW).parameters
+    extra_kwargs = {"fused": True} if fused else {}
+    return torch.optim.AdamW(params, lr=args.learning_rate, eps=1e-6, weight_decay=0.0, **extra_kwargs)
+
+
+def train_with_prepped_dataset(
+    train_dataset, eval_dataset, probed_model, args, accelerator, tokenizer, data_collator=default_data_collator
+):
     # DataLoaders creation:
     train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=default_data_collator, batch_size=args.per_device_train_batch_size
+        train_dataset,
+        shuffle=True,
+        collate_fn=data_collator,
+        batch_size=args.per_device_train_batch_size,
+        **get_dataloader_kwargs(args),
     )
     eval_dataloader = DataLoader(
-        eval_dataset, collate_fn=default_data_collator, batch_size=args.per_device_eval_batch_size
+        eval_dataset,
+        collate_fn=data_collator,
+        batch_size=args.per_device_eval_batch_size,
+        **get_dataloader_kwargs(args),
     )
     # Optimizer
     # Split weights in two groups, one with weight decay and the other not.
@@ -418,14 +672,23 @@ def train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args,
             "weight_decay": 0.0,
         },
     ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
-    # Prepare everything with our `accelerator`.
+    # Params must already live on the device for the fused optimizer, so move the model before building it.
+    probed_model.to(accelerator.device)
+    optimizer = create_optimizer(args, optimizer_grouped_parameters)
+    # Prepare everything with our `accelerator`. The prepared dataloaders place the (pinned) batches on the device with
+    # non-blocking copies, see the `DataLoaderConfiguration` in main(). On GPU, the training batches are left on the
+    # host instead and copied over by a `DataPrefetcher`, so the copy of the next batch overlaps with the current step.
+    # The eval dataloader keeps the placement of accelerate, which gather_for_metrics relies on.
+    use_prefetcher = accelerator.device.type == "cuda" and accelerator.distributed_type != DistributedType.DEEPSPEED
+    device_placement = [True, True, False, True] if use_prefetcher else None
     probed_model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
-        probed_model, optimizer, train_dataloader, eval_dataloader
+        probed_model, optimizer, train_dataloader, eval_dataloader, device_placement=device_placement
     )
+    if use_prefetcher:
+        train_dataloader = DataPrefetcher(train_dataloader, accelerator.device)
 
     # On TPU, the tie weights in our model have been disconnected, so we need to restore the ties.
-    if accelerator.distributed_type == DistributedType.TPU:
+    if accelerator.distributed_type == DistributedType.XLA:
         probed_model.tie_weights()
 
     # Note -> the training dataloader needs to be prepared before we grab his length below (cause its length will be
@@ -463,14 +726,22 @@ def train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args,
         if not args.eval_only:
             probed_model.train()
             for step, batch in enumerate(train_dataloader):
-                outputs = probed_model(**batch)
-                loss = outputs.loss
-                loss = loss / args.gradient_accumulation_steps
-                accelerator.backward(loss)
-                if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
+                # Step at the end of each accumulation window and at the end of the epoch. The window is tracked here
+                # rather than with `accelerator.accumulate`, which would end it one batch early behind the prefetcher.
+                sync_gradients = (
+                    (step + 1) % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1
+                )
+                # The accelerator scales the loss, and the gradients are only all-reduced on the last micro-batch.
+                with contextlib.nullcontext() if sync_gradients else accelerator.no_sync(probed_model):
+                    with accelerator.autocast():
+                        outputs = probed_model(**batch)
+                    loss = outputs.loss
+                    accelerator.backward(loss)
+
+                if sync_gradients:
                     optimizer.step()
                     lr_scheduler.step()
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
                     progress_bar.update(1)
                     completed_steps += 1
 
@@ -478,7 +749,9 @@ def train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args,
                     break
 
         probed_model.eval()
-        losses = []
+        # Keep running totals on the device instead of a list of gathered per-step losses.
+        total_loss = torch.zeros((), device=accelerator.device)
+        total_count = torch.zeros((), device=accelerator.device)
         for step, batch in enumerate(eval_dataloader):
             with torch.no_grad():
                 outputs = probed_model(**batch)
@@ -490,12 +763,15 @@ def train_with_prepped_dataset(train_dataset, eval_dataset, probed_model, args,
                 print("Label:\t\t", batch['labels'])
                 print()
             loss = outputs.loss
-            losses.append(accelerator.gather(loss.repeat(args.per_device_eval_batch_size)))
+            batch_size = batch['input_ids'].size(0)
+            # gather_for_metrics drops the samples duplicated to fill the last batch across processes. The gathered
+            # losses stay on the device, so this does not wait for the GPU.
+            losses = accelerator.gather_for_metrics(loss.detach().repeat(batch_size))
+            total_loss += losses.sum()
+            total_count += losses.numel()
 
-        losses = torch.cat(losses)
-        losses = losses[: len(eval_dataset)]
         try:
-            perplexity = math.exp(torch.mean(losses))
+            perplexity = math.exp((total_loss / total_count).item())
         except OverflowError:
             perplexity = float("inf")
 
@@ -514,20 +790,21 @@ def _gen_xfacts(args, probed_model, tokenizer, accelerator, raw_datasets):
     label_column_name = 'gender'
     label_mapping = {0: 0, 1: 1, 2: 2}
 
-    def tokenize_function(examples):
-        tokenized_batch = tokenizer(examples[text_column_name])
-        return tokenized_batch
-
     def label_to_int(batch):
         batch[label_column_name] = [label_mapping[label] for label in batch[label_column_name]]
         return batch
 
+    # Same filter as the probe, see _train_probe.
+    max_length = _get_block_size(args, tokenizer) if args.pad_to_max_length else None
+
     def too_long(batch):
+        if max_length is not None and len(batch['input_ids']) > max_length:
+            return False
         return 3 < len(batch['input_ids']) < tokenizer.model_max_length
 
     with accelerator.main_process_first():
         tokenized_datasets = raw_datasets.map(
-            tokenize_function,
+            partial(tokenize_function, tokenizer=tokenizer, text_column_name=text_column_name),
             batched=True,
             num_proc=args.preprocessing_num_workers,
             load_from_cache_file=not args.overwrite_cache,
@@ -536,64 +813,176 @@ def _gen_xfacts(args, probed_model, tokenizer, accelerator, raw_datasets):
     tokenized_datasets = tokenized_datasets.map(label_to_int, batched=True)
     tokenized_datasets = tokenized_datasets.filter(too_long, batched=False)
     tokenized_datasets = tokenized_datasets.rename_column(label_column_name, 'labels')
+    tokenized_datasets = _keep_probe_columns(tokenized_datasets)
     train_dataset = tokenized_datasets["train"]
     print(next(iter(train_dataset)))
     eval_dataset = tokenized_datasets["validation"]
+    # Always pad here: the sentences of a batch have different lengths, and the padding is trimmed off again below.
+    data_collator = get_probe_data_collator(args, tokenizer, max_length)
     # DataLoaders creation:
     train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=default_data_collator, batch_size=args.per_device_train_batch_size
+        train_dataset,
+        shuffle=True,
+        collate_fn=data_collator,
+        batch_size=args.per_device_train_batch_size,
+        **get_dataloader_kwargs(args),
     )
     eval_dataloader = DataLoader(
-        eval_dataset, collate_fn=default_data_collator, batch_size=args.per_device_eval_batch_size
+        eval_dataset,
+        collate_fn=data_collator,
+        batch_size=args.per_device_eval_batch_size,
+        **get_dataloader_kwargs(args),
     )
     probed_model, train_dataloader, eval_dataloader = accelerator.prepare(
         probed_model, train_dataloader, eval_dataloader
     )
     completed_steps = 0
+    # The prepared dataloader gives every process its own shard of the sentences, so each one only generates its share
+    # of the max_train_steps xfacts. The shards are gathered back together afterwards, in main().
+    max_xfacts = math.ceil(args.max_train_steps / accelerator.num_processes)
     probed_model.train()
-    probe = probed_model.classifier.classifier
-    cached_input_ids = []
-    cached_z_primes = []
+    # The prepared model is wrapped (e.g. in DDP) when running on several processes, so get the probe from the model
+    # underneath.
+    probe = accelerator.unwrap_model(probed_model).classifier.classifier
+    # The cache is written into preallocated (pinned) host buffers instead of stacking a list of tensors at the end,
+    # which would hold two copies of the whole dataset at once. Each sentence yields 3 xfacts of (length - 1) tokens,
+    # so the longest sentences give an upper bound on the number of rows we can write before stopping.
+    # The lengths are computed by `datasets` in batches and read back as a single numpy column, instead of loading
+    # every sentence into a Python list.
+    num_sentences = math.ceil(min(max_xfacts, 3 * len(train_dataset)) / 3)
+    lengths = train_dataset.map(
+        sequence_lengths, batched=True, remove_columns=train_dataset.column_names, desc="Measuring sentence lengths"
+    ).with_format("numpy")["length"]
+    max_rows = 3 * int(np.sort(lengths - 1)[::-1][:num_sentences].sum())
+    pin_memory = torch.cuda.is_available()
+    stacked_z_primes = None  # Allocated once we know the dtype and size of the embeddings.
+    stacked_input_ids = torch.empty((max_rows, 1), dtype=torch.long, pin_memory=pin_memory)
+    num_rows = 0
+    # Created once on the device, so the loop never builds small host tensors to copy over.
+    target_classes = torch.arange(3, device=accelerator.device)
+    # Run the probe of the search in bf16 too when training in bf16. fp16 is left out: it would need loss scaling.
+    autocast_dtype = torch.bfloat16 if args.mixed_precision == "bf16" else None
+    # Sentences waiting for their counterfactual search, as (hidden states, input ids) pairs.
+    pending = []
     for step, batch in enumerate(train_dataloader):
+        # Read the sentence lengths before the forward, so this only waits for the copy of the batch. GPT-2 tokenizers
+        # pad on the right, so the first `length` positions of each row are the sentence.
+        sentence_lengths = batch['attention_mask'].sum(-1).tolist()
         batch['output_hidden_states'] = True
         with torch.no_grad():
             outputs = probed_model(**batch)
         hidden_states = outputs.hidden_states[-1].detach()  # Take last ones before the linear layer.
+        if args.torch_compile:
+            # With cudagraphs, the outputs are static buffers that the next forward overwrites, but the pending
+            # sentences are only searched a few batches later.
+            hidden_states = hidden_states.clone()
         # FIXME: not just last layer (see above)
-        for targ_s in range(3):
-            s_prime = torch.unsqueeze(torch.tensor(targ_s), 0).cuda()
-            z_prime = gen_counterfactual(hidden_states, probe, s_prime)
-            # We generate input ids and xfactual embeddings for the whole sequence, but one has to decide what parts to
-            # add to the dataset. Regardless of the option, remember to shift!
-            # Here's the whole sequence.
-            squeezed_z = torch.squeeze(z_prime, dim=0)
-            shifted_z = squeezed_z[:-1, :].contiguous()
-            labels = batch['input_ids'].view((-1, 1))
-            shifted_labels = labels[1:, ...].contiguous()
-            cached_input_ids.append(shifted_labels)
-            cached_z_primes.append(shifted_z)
-            # Or one can focus only on specific tokens
-            # Minus 2 for the penultimate token.
-            # cached_input_ids.append(batch['input_ids'][0, -2].view((-1, 1)))
-            # cached_z_primes.append(z_prime[0, -3].view(1, -1))  # Shift z-prime by one earlier to allow prediction.
-            # Debugging tool prints out the token being added to the dataset
-            # print("Decoding token", tokenizer.decode(cached_input_ids[-1][0]))
-            completed_steps += 1
-            if completed_steps >= args.max_train_steps:
+        pending.extend(
+            (states[:length], input_ids[:length])
+            for states, input_ids, length in zip(hidden_states, batch['input_ids'], sentence_lengths)
+        )
+        # Don't search for more sentences than we still need to reach max_xfacts.
+        sentences_needed = math.ceil((max_xfacts - completed_steps) / 3)
+        is_last_batch = step == len(train_dataloader) - 1
+        if len(pending) < min(args.xfact_batch_size, sentences_needed) and not is_last_batch:
+            continue
+        xfacts = _search_xfacts(
+            pending[:sentences_needed], probe, target_classes, args.xfact_optimizer, autocast_dtype
+        )
+        new_z_primes = []
+        new_input_ids_list = []
+        for input_ids, z_primes in xfacts:
+            labels = input_ids.view((-1, 1))
+            shifted_labels = labels[1:, ...]
+            for z_prime in z_primes:
+                # We generate input ids and xfactual embeddings for the whole sequence, but one has to decide what
+                # parts to add to the dataset. Regardless of the option, remember to shift!
+                # Here's the whole sequence.
+                shifted_z = z_prime[:-1, :]
+                new_input_ids = shifted_labels
+                # Or one can focus only on specific tokens
+                # Minus 2 for the penultimate token.
+                # new_input_ids = input_ids[-2].view((-1, 1))
+                # shifted_z = z_prime[-3].view(1, -1)  # Shift z-prime by one earlier to allow prediction.
+                # Debugging tool prints out the token being added to the dataset
+                # print("Decoding token", tokenizer.decode(new_input_ids[0]))
+                new_z_primes.append(shifted_z.detach())
+                new_input_ids_list.append(new_input_ids)
+                completed_steps += 1
+                if completed_steps >= max_xfacts:
+                    break
+            if completed_steps >= max_xfacts:
                 break
-        if completed_steps >= args.max_train_steps:
+        # Copy the xfacts of the whole search to the host at once, instead of with two small copies per xfact. They are
+        # views into the buffer of the search, so this also has to happen before the next one.
+        new_z_primes = torch.cat(new_z_primes)
+        if stacked_z_primes is None:
+            stacked_z_primes = torch.empty(
+                (max_rows, new_z_primes.size(-1)), dtype=new_z_primes.dtype, pin_memory=pin_memory
+            )
+        new_rows = new_z_primes.size(0)
+        stacked_z_primes[num_rows: num_rows + new_rows].copy_(new_z_primes)
+        stacked_input_ids[num_rows: num_rows + new_rows].copy_(torch.cat(new_input_ids_list))
+        num_rows += new_rows
+        pending = []
+        if completed_steps >= max_xfacts:
             break
-    stacked_z_primes = torch.vstack(cached_z_primes)
-    stacked_input_ids = torch.vstack(cached_input_ids)
-    xfact_dataset = torch.utils.data.TensorDataset(stacked_z_primes, stacked_input_ids)
+    xfact_dataset = torch.utils.data.TensorDataset(stacked_z_primes[:num_rows], stacked_input_ids[:num_rows])
     return xfact_dataset
 
 
+def _search_xfacts(pending, probe, target_classes, optimizer_name, autocast_dtype):
+    # Search for the counterfactuals of all the pending sentences and all 3 target genders in a single batched
+    # optimization. The sentences are zero-padded to a common length, and the padding is masked out of the probe input.
+    # Yields the input ids of each sentence with its 3 counterfactuals, trimmed back to the sentence length. These are
+    # views into a buffer shared by all searches, so they have to be copied out before the next search.
+    num_targets = len(target_classes)
+    max_length = max(len(states) for states, _ in pending)
+    first_states = pending[0][0]
+    z_primes = get_z_buffer(
+        (num_targets, len(pending), max_length, first_states.size(-1)), first_states.device, first_states.dtype
+    )
+    z_primes.zero_()
+    for i, (states, _) in enumerate(pending):
+        z_primes[:, i, :len(states)] = states
+    mask = pad_sequence([states.new_ones(len(states), 1) for states, _ in pending], batch_first=True)
+    s_primes = target_classes.repeat_interleave(len(pending))
+    gen_counterfactual(
+        z_primes.view(-1, *z_primes.shape[2:]),
+        probe,
+        s_primes,
+        mask=mask.repeat(num_targets, 1, 1),
+        optimizer_name=optimizer_name,
+        autocast_dtype=autocast_dtype,
+    )
+    for i, (states, input_ids) in enumerate(pending):
+        yield input_ids, z_primes[:, i, :len(states)]
+
+
+def _gather_xfacts(accelerator, xfact_dataset):
+    # Concatenate the xfacts generated by every process, so they all train on the same dataset (the prepared
+    # dataloader in _xfact_training then shards it again). Processes can end up with different numbers of rows, so
+    # pad before gathering and drop the padding rows afterwards.
+    if accelerator.num_processes == 1:
+        return xfact_dataset
+    num_rows = accelerator.gather(torch.tensor([len(xfact_dataset)], device=accelerator.device)).tolist()
+    gathered = []
+    for tensor in xfact_dataset.tensors:
+        tensor = accelerator.gather(accelerator.pad_across_processes(tensor.to(accelerator.device), dim=0)).cpu()
+        chunks = tensor.split(max(num_rows))
+        gathered.append(torch.cat([chunk[:rows] for chunk, rows in zip(chunks, num_rows)]))
+    return torch.utils.data.TensorDataset(*gathered)
+
+
 def _xfact_training(args, probed_model, accelerator, xfact_dataset):
     # Just train the LM head on the xfact dataset, mapping from counterfactual embeddings to the desired next token id.
-    loaded_data = DataLoader(xfact_dataset, shuffle=True)
+    # Each example is a single embedding, so batch them up to run the LM head as one matmul instead of one per token.
+    loaded_data = DataLoader(
+        xfact_dataset, shuffle=True, batch_size=args.xfact_train_batch_size, **get_dataloader_kwargs(args)
+    )
     lm_head = probed_model.lm.lm_head
-    optimizer = AdamW(lm_head.parameters(), lr=args.learning_rate)
+    lm_head.to(accelerator.device)
+    optimizer = create_optimizer(args, lm_head.parameters())
     # Prepare everything with our `accelerator`.
     lm_head, optimizer, train_dataloader = accelerator.prepare(
         lm_head, optimizer, loaded_data
@@ -603,30 +992,28 @@ def _xfact_training(args, probed_model, accelerator, xfact_dataset):
     for epoch in range(3):
         print("Epoch", epoch)
         lm_head.train()
-        running_loss = 0
-        for step, batch in enumerate(loaded_data):
+        # Accumulate on the device, so we only wait for the GPU once per epoch instead of at every step.
+        running_loss = torch.zeros((), device=accelerator.device)
+        for step, batch in enumerate(train_dataloader):
             embedding, label = batch
             prediction = lm_head(embedding)
             loss = loss_fn(prediction, label.view(-1))
-            running_loss += loss.detach().cpu().numpy().item()
+            running_loss += loss.detach()
             accelerator.backward(loss)
             optimizer.step()
-            optimizer.zero_grad()
-        print("Loss:\t", running_loss / len(loaded_data))
+            optimizer.zero_grad(set_to_none=True)
+        print("Loss:\t", (running_loss / len(loaded_data)).item())
 
 
-def _measure_ppl(args, probed_model, tokenizer):
+def _measure_ppl(args, probed_model, tokenizer, accelerator):
     probed_model.lm_mode = True
     probed_model.eval()
-    probed_model.cuda()
+    probed_model.to(accelerator.device)
 
     data = load_dataset(args.lm_dataset_name, data_files='suite.txt', split='train')
-    def tokenize_function(examples):
-        text_column_name = 'text'
-        tokenized_batch = tokenizer(examples[text_column_name])
-        return tokenized_batch
     encodings = data.map(
-        tokenize_function,
+        # The offsets let us locate the surprisal word by character position instead of decoding every token.
+        partial(tokenize_function, tokenizer=tokenizer, text_column_name='text', return_offsets_mapping=True),
         batched=True,
         num_proc=args.preprocessing_num_workers,
         load_from_cache_file=not args.overwrite_cache,
@@ -635,38 +1022,137 @@ def _measure_ppl(args, probed_model, tokenizer):
     # And parse out the specific words we want to have the indices of
     special_idxs = []
     with open(args.lm_dataset_name + '/surprisal_tokens.txt', 'r') as f:
-        for word, sentence in zip(f, encodings['input_ids']):
-            found_match = False
-            for i, tok in enumerate(sentence):
-                decoded = tokenizer.decode(tok).strip()
-                if word.startswith(decoded):
-                    special_idxs.append(i - 1)  # Shift by 1 to get the surprisal for prediction at the earlier step.
-                    found_match = True
-                    break
-            assert found_match, "Could not find matching token for word " + word
-
+        for word, text, offsets in zip(f, encodings['text'], encodings['offset_mapping']):
+            word = word.strip()
+            match = re.search(r"(?<!\w)" + re.escape(word) + r"(?!\w)", text)
+            assert match is not None, "Could not find word " + word + " in sentence " + text
+            # The first token whose character span covers the start of the word.
+            token_idx = next((i for i, (start, end) in enumerate(offsets) if start <= match.start() < end), None)
+            assert token_idx is not None, "Could not find matching token for word " + word
+            # There is no prediction for the first token, and index -1 would read a padded position of the batch.
+            assert token_idx > 0, "Cannot measure the surprisal of the first word in sentence " + text
+            special_idxs.append(token_idx - 1)  # Shift by 1 to get the surprisal for prediction at the earlier step.
+    special_idxs = torch.tensor(special_idxs, device=accelerator.device)
+
+    # Score the sentences in padded batches rather than one forward pass per sentence. Padding goes on the right, so
+    # with causal attention it does not change the logits of the real tokens.
     nlls = []
-    for sentence, token_idx in zip(encodings['input_ids'], special_idxs):
-        input_ids = torch.Tensor(sentence).cuda().long()
+    loss_fct = CrossEntropyLoss(reduction='none')
+    for start in range(0, len(special_idxs), args.per_device_eval_batch_size):
+        end = start + args.per_device_eval_batch_size
+        sentences = [torch.tensor(sentence) for sentence in encodings['input_ids'][start:end]]
+        token_idxs = special_idxs[start:end]
+        # The token lists give int64 tensors already, so they only need a single copy to the device.
+        input_ids = pad_sequence(sentences, batch_first=True).to(accelerator.device, non_blocking=True)
+        attention_mask = pad_sequence([torch.ones_like(sentence) for sentence in sentences], batch_first=True)
+        attention_mask = attention_mask.to(accelerator.device, non_blocking=True)
         with torch.no_grad():
-            outputs = probed_model(input_ids, labels=input_ids)
-            neg_log_likelihood = outputs.loss
+            outputs = probed_model(input_ids, attention_mask=attention_mask)
             # In addition to the overal surprisal, print out the surprisal for each token, which allows us to peek
             # into specific words.
             shift_logits = outputs.logits[..., :-1, :].contiguous()
             shift_labels = input_ids[..., 1:].contiguous()
-            loss_fct = CrossEntropyLoss(reduction='none')
             surprisals = loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
-            print('surprisals', surprisals[token_idx])
-        nlls.append(surprisals[token_idx].cpu().numpy())
-    print(np.mean(nlls))
+            surprisals = surprisals.view(shift_labels.shape)
+            token_surprisals = surprisals[torch.arange(len(sentences), device=surprisals.device), token_idxs]
+        for token_surprisal in token_surprisals:
+            print('surprisals', token_surprisal)
+        nlls.append(token_surprisals.cpu().numpy())
+    print(np.mean(np.concatenate(nlls)))
+
+
+def _build_classifier(config, lm_model, tokenizer):
+    # GPT2ProbedCLM replaces the classifier's transformer with the LM's, so there is no point in allocating and
+    # initializing a second one. With torch >= 2.0, build the classifier on the meta device and only materialize (and
+    # initialize) its probe head.
+    if version.parse(torch.__version__).release < (2, 0):
+        classifier_model = GPT2ForSequenceClassification(config)
+        classifier_model.resize_token_embeddings(len(tokenizer))
+        return classifier_model
+    with torch.device("meta"), no_init_weights():
+        classifier_model = GPT2ForSequenceClassification(config)
+    classifier_model.transformer = lm_model.transformer
+    classifier_model.classifier.to_empty(device=lm_model.device)
+    classifier_model.classifier.apply(classifier_model._init_weights)
+    return classifier_model
+
+
+def _set_pad_token(tokenizer):
+    # GPT-2 tokenizers have no padding token. Pad with the end of sequence token instead: the padded positions are
+    # masked out anyway, and unlike adding a new token this does not resize the embeddings.
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+
+def _build_probed_model(lm_config, lm_model, tokenizer):
+    copied = copy.deepcopy(lm_config)
+    copied.num_labels = 3  # FIXME. Works for Wizard, but not for example imdb
+    copied.pad_token_id = tokenizer.pad_token_id  # Lets the classifier accept padded batches.
+    classifier_model = _build_classifier(copied, lm_model, tokenizer)
+    return GPT2ProbedCLM(lm_config, lm_model, classifier_model)
+
+
+def _save_safetensors(model, model_file):
+    # Written next to model.pt when safetensors is installed, so the model can be loaded without unpickling it.
+    try:
+        from safetensors.torch import save_model
+    except ImportError:
+        return
+    # save_model only keeps one copy of the tensors shared between the LM and the classifier.
+    save_model(model, model_file)
+
+
+def _load_probed_model(model_dir, tokenizer, accelerator):
+    # Prefer model.safetensors: it is memory-mapped and loaded straight to the device, into a model built on the meta
+    # device, instead of unpickling the whole model in CPU memory first.
+    model_file = os.path.join(model_dir, "model.safetensors")
+    if os.path.isfile(model_file) and version.parse(torch.__version__).release >= (2, 0):
+        try:
+            from safetensors.torch import load_model
+        except ImportError:
+            logger.warning(f"Found {model_file} but safetensors is not installed, loading model.pt instead.")
+        else:
+            lm_config = AutoConfig.from_pretrained(model_dir)
+            with torch.device("meta"):
+                lm_model = AutoModelForCausalLM.from_config(lm_config)
+                probed_model = _build_probed_model(lm_config, lm_model, tokenizer)
+            probed_model.to_empty(device=accelerator.device)
+            probed_model.lm.tie_weights()  # to_empty gives every parameter its own storage, so tie them again.
+            load_model(probed_model, model_file, device=str(accelerator.device))
+            return probed_model
+    # model.pt pickles the whole model, not just its tensors. Recent torch versions default to weights_only=True, which
+    # refuses to load it.
+    load_kwargs = {"weights_only": False} if version.parse(torch.__version__).release >= (1, 13) else {}
+    return torch.load(os.path.join(model_dir, "model.pt"), **load_kwargs)
 
 
 def main():
+    # The probe, LM and xfact stages allocate differently sized buffers in turn. Expandable segments let the caching
+    # allocator grow its blocks instead of fragmenting, so the stages can reuse each other's memory. This has to be
+    # set before the first CUDA allocation, and older versions reject the option.
+    if version.parse(torch.__version__).release >= (2, 1):
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+    # Without this, NCCL marks the tensors of every collective with record_stream, so the allocator only frees them
+    # once the NCCL stream catches up. None of the tensors given to a collective are kept past its return here.
+    os.environ.setdefault("TORCH_NCCL_AVOID_RECORD_STREAMS", "1")
     args = parse_args()
 
+    # Use the TF32 tensor core path for fp32 matmuls on Ampere+ GPUs and let cuDNN pick its fastest kernels.
+    if not args.no_tf32:
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+
     # Initialize the accelerator. We will let the accelerator handle device placement for us in this example.
-    accelerator = Accelerator()
+    # Mixed precision is also handled by the accelerator (autocast on the forward pass, loss scaling on backward).
+    # With multiple GPUs, let the DDP gradients be views into the all-reduce buckets to avoid an extra copy per step.
+    # The dataloaders return pinned memory on GPU, so their batches can be copied to the device without blocking.
+    accelerator = Accelerator(
+        mixed_precision=args.mixed_precision,
+        gradient_accumulation_steps=args.gradient_accumulation_steps,
+        dataloader_config=DataLoaderConfiguration(non_blocking=True),
+        kwargs_handlers=[DistributedDataParallelKwargs(gradient_as_bucket_view=True)],
+    )
     # Make one log on every process with the configuration for debugging.
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -703,21 +1189,28 @@ def main():
     # In distributed training, the .from_pretrained methods guarantee that only one local process can concurrently
     # download model & vocab.
     if args.model_name_or_path is not None:
-        probed_model = torch.load(args.model_name_or_path + '/model.pt')
-        tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=not args.use_slow_tokenizer)
+        tokenizer = AutoTokenizer.from_pretrained(
+            args.model_name_or_path, cache_dir=args.cache_dir, use_fast=not args.use_slow_tokenizer
+        )
+        _set_pad_token(tokenizer)
+        probed_model = _load_probed_model(args.model_name_or_path, tokenizer, accelerator)
     else:
         if args.config_name:
-            lm_config = AutoConfig.from_pretrained(args.config_name)
+            lm_config = AutoConfig.from_pretrained(args.config_name, cache_dir=args.cache_dir)
         elif args.lm_model_name_or_path:
-            lm_config = AutoConfig.from_pretrained(args.lm_model_name_or_path)
+            lm_config = AutoConfig.from_pretrained(args.lm_model_name_or_path, cache_dir=args.cache_dir)
         else:
             lm_config = CONFIG_MAPPING[args.model_type]()
             logger.warning("You are instantiating a new config instance from scratch.")
 
         if args.tokenizer_name:
-            tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=not args.use_slow_tokenizer)
+            tokenizer = AutoTokenizer.from_pretrained(
+                args.tokenizer_name, cache_dir=args.cache_dir, use_fast=not args.use_slow_tokenizer
+            )
         elif args.lm_model_name_or_path:
-            tokenizer = AutoTokenizer.from_pretrained(args.lm_model_name_or_path, use_fast=not args.use_slow_tokenizer)
+            tokenizer = AutoTokenizer.from_pretrained(
+                args.lm_model_name_or_path, cache_dir=args.cache_dir, use_fast=not args.use_slow_tokenizer
+            )
         else:
             raise ValueError(
                 "You are instantiating a new tokenizer from scratch. This is not supported by this script."
@@ -729,22 +1222,33 @@ def main():
                 args.lm_model_name_or_path,
                 from_tf=bool(".ckpt" in args.lm_model_name_or_path),
                 config=lm_config,
+                cache_dir=args.cache_dir,
             )
         else:
             logger.info("Training new model from scratch")
             lm_model = AutoModelForCausalLM.from_config(lm_config)
 
         lm_model.resize_token_embeddings(len(tokenizer))
-        copied = copy.deepcopy(lm_config)
-        copied.num_labels = 3  # FIXME. Works for Wizard, but not for example imdb
-        classifier_model = GPT2ForSequenceClassification(copied)
-        classifier_model.resize_token_embeddings(len(tokenizer))
-        probed_model = GPT2ProbedCLM(lm_config, lm_model, classifier_model)
+        _set_pad_token(tokenizer)
+        probed_model = _build_probed_model(lm_config, lm_model, tokenizer)
+
+    # Activate gradient checkpointing if needed. The shared transformer is checkpointed for both the LM and the probe.
+    if args.gradient_checkpointing:
+        probed_model.gradient_checkpointing_enable()
+        # The KV cache is incompatible with checkpointing, so turn it off for every config sharing the transformer.
+        for config in (probed_model.config, probed_model.lm.config, probed_model.classifier.config):
+            config.use_cache = False
+    # Compile the LM and the classifier in place, once for the whole run. Switching `lm_mode` then only picks which of
+    # the two compiled modules runs, instead of invalidating the guards of a single compiled model at every stage.
+    # Variable sequence lengths still trigger recompilations, which is why this is opt-in.
+    if args.torch_compile:
+        probed_model.lm.compile(mode="reduce-overhead")
+        probed_model.classifier.compile(mode="reduce-overhead")
     if args.eval_only:
         for test_suite in ['data/mycal_gender_stereotypical', 'data/mycal_gender_counter']:
             args.lm_dataset_name = test_suite
             print("Test suite", test_suite)
-            _measure_ppl(args, probed_model, tokenizer)
+            _measure_ppl(args, probed_model, tokenizer, accelerator)
         return
     # Do the actual training
     for iteration in range(2):
@@ -760,9 +1264,9 @@ def main():
         print("Generating xfacts")
         probed_model.lm_mode = False
         xfact_dataset = _gen_xfacts(args, probed_model, tokenizer, accelerator, probe_raw_datasets)
+        xfact_dataset = _gather_xfacts(accelerator, xfact_dataset)
         print("Training with xfacts")
         _xfact_training(args, probed_model, accelerator, xfact_dataset)
-        torch.cuda.empty_cache()
     if args.output_dir is not None:
         accelerator.wait_for_everyone()
         unwrapped_model = accelerator.unwrap_model(probed_model)
@@ -770,6 +1274,8 @@ def main():
         if accelerator.is_main_process:
             tokenizer.save_pretrained(args.output_dir)
         torch.save(unwrapped_model, args.output_dir + "/model.pt")
+        if accelerator.is_main_process:
+            _save_safetensors(unwrapped_model, os.path.join(args.output_dir, "model.safetensors"))
 
 
 if __name__ == "__main__":
@@ -1410,6 +1410,9 @@ class GPT2ForSequenceClassification(GPT2PreTrainedModel):
         # Normally, we pull out the last token and use logits from that, but I'm passing in all the hidden states
         # into the classifier.
         # pooled_logits = logits[torch.arange(batch_size, device=self.device), sequence_lengths]
+        if attention_mask is not None:
+            # Zero out the padded positions, so padded batches look like the probe's own zero-padding.
+            hidden_states = hidden_states * attention_mask.view(batch_size, -1, 1).to(hidden_states.dtype)
         pooled_logits = self.classifier(hidden_states)
 
         loss = None
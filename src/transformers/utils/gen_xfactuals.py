@@ -1,39 +1,223 @@
+import inspect
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
 
 
-def gen_counterfactual(z, probe, s_prime, criterion=None):
+# Number of eager steps to run on a side stream before capturing the step into a CUDA graph, and number of graph
+# replays between two reads of the loss (each read waits for the GPU).
+_GRAPH_WARMUP_STEPS = 3
+_LOSS_CHECK_INTERVAL = 16
+# The step is only captured with torch >= 2.1, where torch.cuda.graph takes a capture_error_mode (see _capture_step).
+_CAN_CAPTURE_STEP = hasattr(torch.cuda, "graph") and (
+    "capture_error_mode" in inspect.signature(torch.cuda.graph.__init__).parameters
+)
+
+# Storage shared by the tensors returned from get_z_buffer. It only grows, so once it fits the largest search it is
+# never reallocated.
+_z_buffer = None
+
+
+def get_z_buffer(shape, device, dtype):
+    # Returns an uninitialized tensor of the given shape for gen_counterfactual to optimize in place. It is a view into
+    # storage shared by all calls, so it is overwritten by the next call: copy the result out before that.
+    global _z_buffer
+    numel = torch.Size(shape).numel()
+    if _z_buffer is None or _z_buffer.numel() < numel or _z_buffer.device != device or _z_buffer.dtype != dtype:
+        _z_buffer = None  # Let the allocator reuse the old storage for the new one.
+        _z_buffer = torch.empty(numel, device=device, dtype=dtype)
+    return _z_buffer[:numel].view(shape)
+
+
+def _grad_and_loss(compute_loss, z):
+    # Gradient of compute_loss with respect to z only, without going through z.grad. compute_loss returns the loss and
+    # an auxiliary tensor that is passed through.
+    if hasattr(torch, "func"):
+        grad, (loss, aux) = torch.func.grad_and_value(compute_loss, has_aux=True)(z)
+        return grad, loss, aux
+    with torch.enable_grad():
+        z = z.detach().requires_grad_()
+        loss, aux = compute_loss(z)
+        (grad,) = torch.autograd.grad(loss, z)
+    return grad, loss.detach(), aux
+
+
+def _per_row_loss(probe, criterion, z, s_prime, mask, autocast_dtype):
+    # With autocast_dtype, the probe runs in that precision while z, its gradient and the loss stay in fp32. The cast
+    # cache is disabled because it does not work with CUDA graph capture.
+    probe_input = z if mask is None else z * mask
+    with torch.autocast(z.device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None, cache_enabled=False):
+        logits = probe(probe_input)
+    return criterion(logits.float(), s_prime)
+
+
+def _step(update, probe, criterion, z_prime, s_prime, mask, stopping_loss, autocast_dtype):
+    # Rows are independent searches: only the ones that have not converged yet contribute to the loss, and summing
+    # (rather than averaging) gives each of them the same gradient it would get if it was optimized on its own.
+    def compute_loss(z):
+        per_row_loss = _per_row_loss(probe, criterion, z, s_prime, mask, autocast_dtype)
+        active = per_row_loss.detach() > stopping_loss
+        return (per_row_loss * active).sum(), per_row_loss.detach()
+
+    grad, loss, per_row_loss = _grad_and_loss(compute_loss, z_prime)
+    update(grad, per_row_loss > stopping_loss)
+    return loss, per_row_loss
+
+
+def _capture_step(step):
+    # Warm up on a side stream, then record one whole step into a CUDA graph.
+    # The graph reads and updates its tensors in place, so replaying it runs the next step with a single launch.
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(_GRAPH_WARMUP_STEPS):
+            loss, per_row_loss = step()
+    torch.cuda.current_stream().wait_stream(side_stream)
+    graph = torch.cuda.CUDAGraph()
+    # In the default "global" mode, CUDA calls made by other threads during the capture (like the pin memory thread of
+    # a dataloader) make it fail. Only check the calls of this thread.
+    with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+        static_loss, static_per_row_loss = step()
+    return graph, static_loss, static_per_row_loss, loss, per_row_loss
+
+
+def _track_patience(loss, min_loss, patience):
+    # Same patience rule as checking the loss after every step, but with the state kept in device tensors, so it can
+    # run inside the CUDA graph and never waits for the GPU.
+    improved = loss < min_loss - 0.01
+    min_loss.copy_(torch.where(improved, loss, min_loss))
+    patience.copy_(torch.where(improved, torch.zeros_like(patience), patience + 1))
+
+
+def _read_status(per_row_loss, stopping_loss, patience):
+    # Copy the loss, whether any row is still active and the patience to the host together, so each check costs a
+    # single sync. The loss is summed over all the rows, including the converged ones that no longer get optimized.
+    num_active = (per_row_loss > stopping_loss).sum().to(per_row_loss.dtype)
+    loss, num_active, patience = torch.stack(
+        (per_row_loss.sum(), num_active, patience.to(per_row_loss.dtype))
+    ).tolist()
+    return loss, num_active > 0, patience
+
+
+def _lbfgs_search(z_prime, probe, criterion, s_prime, mask, stopping_loss, max_num_steps, autocast_dtype):
+    # L-BFGS needs the same objective for every evaluation of a step, so the set of active rows is only updated between
+    # steps. num_steps counts function evaluations, to be comparable with the SGD steps.
+    max_iter = 20
+    optimizer = optim.LBFGS(
+        [z_prime], lr=1.0, max_iter=max_iter, max_eval=max_iter, tolerance_grad=1e-4, line_search_fn='strong_wolfe'
+    )
+    with torch.no_grad():
+        per_row_loss = _per_row_loss(probe, criterion, z_prime, s_prime, mask, autocast_dtype)
+    active = per_row_loss > stopping_loss
+
+    def closure():
+        optimizer.zero_grad(set_to_none=True)
+        per_row_loss = _per_row_loss(probe, criterion, z_prime, s_prime, mask, autocast_dtype)
+        loss = (per_row_loss * active).sum()
+        loss.backward()
+        return loss
+
+    num_steps = 0
+    while num_steps < max_num_steps and active.any():
+        optimizer.step(closure)
+        num_steps = optimizer.state[z_prime]['func_evals']
+        with torch.no_grad():
+            per_row_loss = _per_row_loss(probe, criterion, z_prime, s_prime, mask, autocast_dtype)
+        active = per_row_loss > stopping_loss
+    # Report the loss of all the rows, not just of the ones still active.
+    return num_steps, per_row_loss.sum().item()
+
+
+def gen_counterfactual(z, probe, s_prime, criterion=None, mask=None, optimizer_name='sgd', autocast_dtype=None):
+    # z is a batch of embeddings (batch size x num embeddings x embedding_dim) and s_prime holds the target class of
+    # each row. Each row is optimized independently and stops contributing once its own loss is below stopping_loss.
+    # If the rows were padded to a common length, mask (batch size x num embeddings x 1) zeroes the padded positions
+    # so they look like the probe's own padding. A custom criterion must return one loss per row.
+    # optimizer_name picks SGD with momentum or L-BFGS, which usually converges in far fewer steps.
+    # autocast_dtype (e.g. torch.bfloat16) runs the probe forward in lower precision.
+
+    # Only z gets optimized, so freeze the probe while searching: backward then stops at z instead of also computing
+    # (and accumulating) gradients for every probe weight.
+    requires_grad = [param.requires_grad for param in probe.parameters()]
+    probe.requires_grad_(False)
+    try:
+        return _gen_counterfactual(z, probe, s_prime, criterion, mask, optimizer_name, autocast_dtype)
+    finally:
+        for param, param_requires_grad in zip(probe.parameters(), requires_grad):
+            param.requires_grad_(param_requires_grad)
+
+
+def _gen_counterfactual(z, probe, s_prime, criterion, mask, optimizer_name, autocast_dtype):
     z_prime = z
-    z_prime.requires_grad = True
-    # optimizer = optim.SGD([z_prime], lr=0.0001, momentum=0.9)
-    # optimizer = optim.SGD([z_prime], lr=0.001, momentum=0.9)
-    optimizer = optim.SGD([z_prime], lr=0.01, momentum=0.9)  # Good. Generated the prey results.
+    # lr = 0.0001
+    # lr = 0.001
+    lr = 0.01  # Good. Generated the prey results.
+    momentum = 0.9
+    # SGD with momentum, written out as in-place ops instead of going through optim.SGD. Starting from a zero buffer
+    # gives the same first step as optim.SGD, which initializes it with the gradient.
+    momentum_buffer = torch.zeros_like(z_prime)
+
+    def sgd_update(grad, active):
+        # Rows that have converged keep their embeddings: zeroing their momentum stops them from drifting back above
+        # stopping_loss, as if their search had ended.
+        row_mask = active.view(-1, *([1] * (z_prime.dim() - 1))).to(momentum_buffer.dtype)
+        with torch.no_grad():
+            momentum_buffer.mul_(momentum).add_(grad).mul_(row_mask)
+            z_prime.sub_(momentum_buffer, alpha=lr)
+
     if criterion is None:
-        criterion = nn.CrossEntropyLoss()
-    # criterion = nn.BCEWithLogitsLoss()
+        criterion = nn.CrossEntropyLoss(reduction='none')
+    # criterion = nn.BCEWithLogitsLoss(reduction='none')
     num_steps = 0
     stopping_loss = 0.001  # Was 0.05
     # stopping_loss = .001  # Generated the prey results
     loss = 100
+    any_active = True
     max_patience = 10000
     max_num_steps = 100  # FIXME
-    curr_patience = 0
-    min_loss = loss
     probe.eval()
-    while num_steps < max_num_steps and loss > stopping_loss:
-        optimizer.zero_grad()
-        outputs = probe(z_prime)
-        loss = criterion(outputs, s_prime)
-        loss.backward()
-        optimizer.step()
-        if num_steps % 100 == 0:
+    if optimizer_name == 'lbfgs':
+        z_prime.requires_grad = True
+        num_steps, loss = _lbfgs_search(
+            z_prime, probe, criterion, s_prime, mask, stopping_loss, max_num_steps, autocast_dtype
+        )
+        print("Num steps", num_steps, "\tloss", loss)
+        return z_prime
+    # Skip the search, and the graph capture, when every row is already classified as its target. L-BFGS does the
+    # same check before its first step.
+    with torch.no_grad():
+        initial_per_row_loss = _per_row_loss(probe, criterion, z_prime, s_prime, mask, autocast_dtype)
+    if not bool((initial_per_row_loss > stopping_loss).any()):
+        print("Num steps", num_steps, "\tloss", float(initial_per_row_loss.sum()))
+        return z_prime
+    min_loss = torch.full((), float(loss), device=z_prime.device)
+    patience = torch.zeros((), dtype=torch.long, device=z_prime.device)
+
+    def step():
+        loss, per_row_loss = _step(sgd_update, probe, criterion, z_prime, s_prime, mask, stopping_loss, autocast_dtype)
+        _track_patience(loss, min_loss, patience)
+        return loss, per_row_loss
+
+    graph = None
+    if z_prime.is_cuda and _CAN_CAPTURE_STEP:
+        # Kernel launches dominate for such a small problem, so replay the step as a CUDA graph.
+        graph, static_loss, static_per_row_loss, loss, per_row_loss = _capture_step(step)
+        num_steps += _GRAPH_WARMUP_STEPS
+    # Reading the loss waits for the device, so it is only checked every _LOSS_CHECK_INTERVAL steps. This may run up to
+    # _LOSS_CHECK_INTERVAL - 1 extra steps.
+    while num_steps < max_num_steps and any_active:
+        num_chunk_steps = min(_LOSS_CHECK_INTERVAL, max_num_steps - num_steps)
+        for _ in range(num_chunk_steps):
+            if graph is not None:
+                graph.replay()
+                loss, per_row_loss = static_loss, static_per_row_loss
+            else:
+                loss, per_row_loss = step()
+        loss, any_active, curr_patience = _read_status(per_row_loss, stopping_loss, patience)
+        if num_steps < _LOSS_CHECK_INTERVAL:
             print("Loss", loss)
-        num_steps += 1
-        curr_patience += 1
-        if loss < min_loss - 0.01:
-            min_loss = loss
-            curr_patience = 0
+        num_steps += num_chunk_steps
         if curr_patience > max_patience:
             print("Breaking because of patience with loss", loss)
             break
@@ -0,0 +1,88 @@
+# Copyright 2022 The HuggingFace Team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from transformers import is_torch_available
+from transformers.testing_utils import require_torch
+
+
+if is_torch_available():
+    import torch
+    import torch.nn.functional as F
+    from torch.nn.utils.rnn import pad_sequence
+
+    from transformers.models.gpt2.modeling_gpt2 import PaddedProbe
+    from transformers.utils.gen_xfactuals import gen_counterfactual
+
+
+@require_torch
+class GenCounterfactualTest(unittest.TestCase):
+    embed_dim = 8
+    lengths = (4, 7, 5)
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.probe = PaddedProbe(max(self.lengths), self.embed_dim, 3)
+        self.sentences = [torch.randn(length, self.embed_dim) for length in self.lengths]
+        self.targets = torch.tensor([0, 2, 1])
+
+    def pad(self, sentences):
+        z = pad_sequence(sentences, batch_first=True)
+        mask = pad_sequence([sentence.new_ones(len(sentence), 1) for sentence in sentences], batch_first=True)
+        return z, mask
+
+    def per_row_loss(self, z, targets):
+        with torch.no_grad():
+            return F.cross_entropy(self.probe(z), targets, reduction="none")
+
+    def test_batched_search_matches_single_search(self):
+        z, mask = self.pad(self.sentences)
+        z_prime = gen_counterfactual(z.clone(), self.probe, self.targets, mask=mask)
+        for i, (sentence, target) in enumerate(zip(self.sentences, self.targets)):
+            single_z_prime = gen_counterfactual(sentence[None].clone(), self.probe, target[None])
+            self.assertTrue(torch.allclose(z_prime[i, : len(sentence)], single_z_prime[0], atol=1e-5))
+
+    def test_padding_is_left_untouched(self):
+        z, mask = self.pad(self.sentences)
+        for optimizer_name in ("sgd", "lbfgs"):
+            z_prime = gen_counterfactual(z.clone(), self.probe, self.targets, mask=mask, optimizer_name=optimizer_name)
+            z_prime = z_prime.detach()
+            self.assertTrue(torch.equal(z_prime * (1 - mask), torch.zeros_like(z_prime)))
+            for i, sentence in enumerate(self.sentences):
+                self.assertFalse(torch.equal(z_prime[i, : len(sentence)], sentence))
+
+    def test_converged_rows_are_not_updated(self):
+        z, mask = self.pad(self.sentences)
+        target = self.targets[:1]
+        # Search for the first sentence on its own (L-BFGS gets it below the stopping loss), then search again together
+        # with sentences that still need to move: the converged row has to keep its embeddings.
+        converged = gen_counterfactual(
+            z[:1].clone(), self.probe, target, mask=mask[:1], optimizer_name="lbfgs"
+        ).detach()
+        self.assertLess(self.per_row_loss(converged, target).item(), 0.001)
+        batch = torch.cat([converged, z[1:]])
+        for optimizer_name in ("sgd", "lbfgs"):
+            z_prime = gen_counterfactual(
+                batch.clone(), self.probe, self.targets, mask=mask, optimizer_name=optimizer_name
+            ).detach()
+            self.assertTrue(torch.equal(z_prime[0], converged[0]))
+
+    def test_search_reaches_targets(self):
+        z, mask = self.pad(self.sentences)
+        for optimizer_name in ("sgd", "lbfgs"):
+            z_prime = gen_counterfactual(z.clone(), self.probe, self.targets, mask=mask, optimizer_name=optimizer_name)
+            per_row_loss = self.per_row_loss(z_prime.detach(), self.targets)
+            self.assertTrue(torch.all(per_row_loss < self.per_row_loss(z, self.targets)))
+            self.assertTrue(torch.equal(self.probe(z_prime.detach()).argmax(-1), self.targets))